@@ -23,6 +23,11 @@ setup(
     install_requires=[
         "psycopg2-binary>=2.5",
     ],
+    entry_points={
+        "console_scripts": [
+            "tempdb = tempdb.__main__:main",
+        ],
+    },
     extras_require={
         "dev": [
             "pytest>=3",
@@ -1,2 +1,6 @@
 from .discover import *
+from .drivers import *
+from .matrix import *
 from .postgres import *
+from .monitor import *
+from .reaper import *
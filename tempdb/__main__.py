@@ -0,0 +1,50 @@
+import argparse
+import sys
+
+from .reaper import reap
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tempdb")
+    subparsers = parser.add_subparsers(dest="command")
+
+    reap_parser = subparsers.add_parser(
+        "reap",
+        help="Stop and remove clusters left behind by dead processes",
+    )
+    reap_parser.add_argument(
+        "--temp-dir",
+        help="Directory to look for clusters in (default: system temp dir)",
+    )
+    reap_parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=4,
+        help="Number of clusters to remove in parallel (default: 4)",
+    )
+    reap_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10.0,
+        help="Seconds to wait for a postmaster to shut down (default: 10)",
+    )
+    reap_parser.add_argument(
+        "-n", "--dry-run",
+        action="store_true",
+        help="Only list orphaned clusters",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command != "reap":
+        parser.print_help()
+        return 1
+
+    for cluster_dir in reap(
+        args.temp_dir, args.jobs, args.timeout, args.dry_run
+    ):
+        print(cluster_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
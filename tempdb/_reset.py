@@ -0,0 +1,215 @@
+# Support for resetting a database to a baseline by truncating only the tables
+# that were written to. Statement level triggers record which tables have been
+# written to, since the statistics counters are flushed asynchronously and
+# can't be relied upon right after a test has finished.
+#
+# Everything lives in its own schema so databases created from a tracked
+# template inherit the triggers, the baseline rows and the sequence values.
+
+SCHEMA = "tempdb_reset"
+
+
+_install_sql = """
+CREATE SCHEMA {schema};
+
+CREATE TABLE {schema}.dirty_tables (relid oid PRIMARY KEY);
+
+CREATE TABLE {schema}.baselines (
+    relid oid PRIMARY KEY,
+    snapshot name NOT NULL,
+    columns text NOT NULL
+);
+
+CREATE TABLE {schema}.sequences (
+    relid oid PRIMARY KEY,
+    last_value bigint NOT NULL,
+    is_called boolean NOT NULL
+);
+
+-- Writes to a partition are recorded on the root of its partition tree,
+-- since that's where the baseline of a partitioned table is kept
+CREATE FUNCTION {schema}.root(rel oid) RETURNS oid
+LANGUAGE sql STABLE AS $$
+    WITH RECURSIVE up(relid, is_partition) AS (
+        SELECT c.oid, c.relispartition
+        FROM pg_catalog.pg_class c
+        WHERE c.oid = rel
+        UNION ALL
+        SELECT i.inhparent, p.relispartition
+        FROM up
+        JOIN pg_catalog.pg_inherits i ON i.inhrelid = up.relid
+        JOIN pg_catalog.pg_class p ON p.oid = i.inhparent
+        WHERE up.is_partition
+    )
+    SELECT relid FROM up WHERE NOT is_partition
+$$;
+
+-- Runs as the owner, since the roles used by tests usually can't access
+-- this schema
+CREATE FUNCTION {schema}.mark_dirty() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = pg_catalog AS $$
+DECLARE
+    root oid := {schema}.root(TG_RELID);
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM {schema}.dirty_tables WHERE relid = root
+    ) THEN
+        INSERT INTO {schema}.dirty_tables VALUES (root)
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE FUNCTION {schema}.reset() RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    tables oid[];
+    b record;
+BEGIN
+    -- Tables referencing a dirty table must be truncated as well, since
+    -- TRUNCATE refuses to break foreign keys
+    WITH RECURSIVE affected(relid) AS (
+        SELECT relid FROM {schema}.dirty_tables
+        UNION
+        SELECT {schema}.root(con.conrelid)
+        FROM pg_constraint con
+        JOIN affected a ON con.confrelid = a.relid
+        WHERE con.contype = 'f'
+    )
+    SELECT array_agg(relid) INTO tables FROM affected;
+
+    IF tables IS NOT NULL THEN
+        -- Disables foreign key checks and user triggers, including ours,
+        -- while the baseline is restored
+        SET LOCAL session_replication_role = replica;
+
+        -- Inheritance children are tracked on their own, so only truncate
+        -- the table itself. Partitioned tables must be truncated as a whole.
+        EXECUTE 'TRUNCATE ' || (
+            SELECT string_agg(
+                CASE c.relkind WHEN 'p' THEN '' ELSE 'ONLY ' END
+                || c.oid::regclass::text,
+                ', '
+            )
+            FROM pg_class c
+            WHERE c.oid = ANY(tables)
+        );
+
+        FOR b IN
+            SELECT * FROM {schema}.baselines WHERE relid = ANY(tables)
+        LOOP
+            EXECUTE format(
+                'INSERT INTO %s (%s) OVERRIDING SYSTEM VALUE '
+                'SELECT %s FROM {schema}.%I',
+                b.relid::regclass, b.columns, b.columns, b.snapshot
+            );
+        END LOOP;
+
+        DELETE FROM {schema}.dirty_tables;
+    END IF;
+
+    PERFORM setval(relid, last_value, is_called) FROM {schema}.sequences;
+END
+$$;
+
+DO $$
+DECLARE
+    t record;
+    seq record;
+    has_rows boolean;
+BEGIN
+    FOR t IN
+        SELECT c.oid, c.relkind, c.relispartition, (
+            SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum)
+            FROM pg_attribute a
+            WHERE a.attrelid = c.oid
+                AND a.attnum > 0
+                AND NOT a.attisdropped
+                {generated_filter}
+        ) AS columns
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p')
+            AND n.nspname NOT IN (
+                'pg_catalog', 'information_schema', '{schema}'
+            )
+            AND n.nspname NOT LIKE 'pg\\_%'
+    LOOP
+        -- Statement level triggers on a partitioned table don't fire for
+        -- writes made directly to a partition, so every partition gets one
+        EXECUTE format(
+            'CREATE TRIGGER tempdb_reset_mark_dirty '
+            'AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %s '
+            'FOR EACH STATEMENT EXECUTE PROCEDURE {schema}.mark_dirty()',
+            t.oid::regclass
+        );
+
+        -- The rows of partitions are part of the baseline of their root
+        CONTINUE WHEN t.relispartition;
+
+        -- Only keep a copy of tables that have rows to restore. Rows of
+        -- inheritance children are left to the children's own baselines.
+        EXECUTE format(
+            'SELECT EXISTS (SELECT 1 FROM %s%s)',
+            CASE t.relkind WHEN 'p' THEN '' ELSE 'ONLY ' END,
+            t.oid::regclass
+        ) INTO has_rows;
+        IF has_rows THEN
+            EXECUTE format(
+                'CREATE TABLE {schema}.%I AS SELECT %s FROM %s%s',
+                'baseline_' || t.oid,
+                t.columns,
+                CASE t.relkind WHEN 'p' THEN '' ELSE 'ONLY ' END,
+                t.oid::regclass
+            );
+            INSERT INTO {schema}.baselines
+            VALUES (t.oid, 'baseline_' || t.oid, t.columns);
+        END IF;
+    END LOOP;
+
+    FOR seq IN
+        SELECT c.oid
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind = 'S'
+            AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+            AND n.nspname NOT LIKE 'pg\\_%'
+    LOOP
+        EXECUTE format(
+            'INSERT INTO {schema}.sequences '
+            'SELECT %s, last_value, is_called FROM %s',
+            seq.oid, seq.oid::regclass
+        );
+    END LOOP;
+END
+$$;
+"""
+
+
+def install_tracking(conn):
+    """
+    Install change tracking in the database ``conn`` is connected to and
+    record its current contents as the baseline.
+    """
+    server_version, = conn.execute("SHOW server_version_num")[0]
+
+    # Partitions and identity columns, which the tracking relies on, were
+    # added in PostgreSQL 10
+    if int(server_version) < 100000:
+        raise RuntimeError("Tracking changes requires PostgreSQL 10+")
+
+    # Generated columns were added in PostgreSQL 12 and can't be inserted into
+    generated_filter = ""
+    if int(server_version) >= 120000:
+        generated_filter = "AND a.attgenerated = ''"
+
+    conn.execute(_install_sql.format(
+        schema=SCHEMA,
+        generated_filter=generated_filter,
+    ))
+
+
+def reset(conn):
+    """Restore the baseline recorded by :func:`install_tracking`"""
+    conn.execute("SELECT {}.reset()".format(SCHEMA))
@@ -1,9 +1,7 @@
 import os
-import platform
+import sys
 
 from collections import defaultdict
-from glob import glob
-from subprocess import check_output
 
 from ._compat import bstr, ustr
 from .utils import get_version, Version
@@ -61,16 +59,17 @@ def iter_postgres_bin_dirs():
 
     :return: An iterator that yield ``(version, path)`` pairs.
     """
-    system = platform.system()
     dirs = []
-    if system == "Linux":
+    if sys.platform.startswith("linux"):
         # Debian
         dirs.append("/usr/lib/postgresql/*/bin")
 
         # CentOS/RHEL/Fedora
         dirs.append("/usr/pgsql-*/bin")
-    elif system == "Darwin":
+    elif sys.platform == "darwin":
         # Homebrew
+        from subprocess import check_output
+
         try:
             cellar = check_output(["brew", "--cellar"]).strip().decode("utf8")
             dirs.append(os.path.join(cellar, "postgresql/*/bin"))
@@ -88,7 +87,7 @@ def iter_postgres_bin_dirs():
         # Postgres.app in /Applications
         dirs.append("/Applications/Postgres.app/Contents/Versions/*/bin")
     else:
-        raise RuntimeError("Unsupported system {!r}".format(system))
+        raise RuntimeError("Unsupported system {!r}".format(sys.platform))
 
     # Official installation path
     dirs.append("/usr/local/pgsql/bin")
@@ -102,6 +101,8 @@ def iter_postgres_bin_dirs():
     # Postgresql bin directory
     required_bins = {"initdb", "postgres"}
 
+    from glob import glob
+
     # Go through each directory and return the first matching one
     for pattern in dirs:
         for d in glob(pattern):
@@ -0,0 +1,314 @@
+import os
+import struct
+import sys
+
+from ._compat import ustr
+
+
+__all__ = [
+    "DatabaseError",
+    "get_driver",
+]
+
+
+class DatabaseError(Exception):
+    """
+    Raised by the built-in driver when the server reports an error. The
+    ``sqlstate`` attribute contains the error code if one was given.
+    """
+
+    def __init__(self, message, sqlstate=None):
+        super(DatabaseError, self).__init__(message)
+        self.sqlstate = sqlstate
+
+
+class Driver(object):
+    """
+    Minimal interface the cluster uses for its superuser control connection.
+
+    Connections returned by :meth:`connect` are in autocommit mode and must
+    provide ``execute(sql)``, which returns a list of row tuples, and
+    ``close()``.
+    """
+
+    #: Name used to select this driver
+    name = None
+
+    #: Module that must be importable for the driver to be available
+    module = None
+
+    @classmethod
+    def is_available(cls):
+        if cls.module is None:
+            return True
+        try:
+            __import__(cls.module)
+        except ImportError:
+            return False
+        return True
+
+    @classmethod
+    def is_loaded(cls):
+        return cls.module is None or cls.module in sys.modules
+
+    def connect(self, uri):
+        raise NotImplementedError()
+
+
+class _DbApiConnection(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def execute(self, sql):
+        with self._conn.cursor() as c:
+            c.execute(sql)
+            if c.description is None:
+                return []
+            return c.fetchall()
+
+    def close(self):
+        self._conn.close()
+
+
+class Psycopg2Driver(Driver):
+    name = "psycopg2"
+    module = "psycopg2"
+
+    def connect(self, uri):
+        import psycopg2
+
+        conn = psycopg2.connect(ustr(uri))
+        conn.autocommit = True
+        return _DbApiConnection(conn)
+
+
+class PsycopgDriver(Driver):
+    name = "psycopg"
+    module = "psycopg"
+
+    def connect(self, uri):
+        import psycopg
+
+        return _DbApiConnection(psycopg.connect(ustr(uri), autocommit=True))
+
+
+class BuiltinDriver(Driver):
+    """
+    Pure Python client that speaks just enough of the frontend/backend
+    protocol to run simple queries over a UNIX socket. It supports trust,
+    password and MD5 authentication.
+    """
+    name = "builtin"
+
+    def connect(self, uri):
+        return _BuiltinConnection(uri)
+
+
+class _BuiltinConnection(object):
+    _protocol_version = 196608
+
+    def __init__(self, uri):
+        import socket
+
+        self._uri = uri
+        self._pid = os.getpid()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(os.path.join(
+            uri.host,
+            ".s.PGSQL.{}".format(uri.port or 5432),
+        ))
+        self._buf = b""
+
+        # Have the server convert to UTF-8, which is what we decode, whatever
+        # the encoding of the database
+        startup = self._pack_int32(self._protocol_version)
+        for k, v in [
+            ("user", uri.user),
+            ("database", uri.database),
+            ("client_encoding", "UTF8"),
+        ]:
+            if v is not None:
+                startup += k.encode("utf8") + b"\0" + v.encode("utf8") + b"\0"
+        startup += b"\0"
+        self._sock.sendall(self._pack_int32(len(startup) + 4) + startup)
+
+        try:
+            self._authenticate()
+            self._read_until_ready()
+        except Exception:
+            self._sock.close()
+            raise
+
+    @staticmethod
+    def _pack_int32(n):
+        return struct.pack("!i", n)
+
+    @staticmethod
+    def _unpack_int(data, fmt="!i", offset=0):
+        return struct.unpack_from(fmt, data, offset)[0]
+
+    def _recv_exactly(self, n):
+        while len(self._buf) < n:
+            chunk = self._sock.recv(max(n - len(self._buf), 8192))
+            if not chunk:
+                raise DatabaseError(
+                    "Server closed the connection unexpectedly"
+                )
+            self._buf += chunk
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+    def _read_message(self):
+        header = self._recv_exactly(5)
+        length = self._unpack_int(header, offset=1)
+        return header[:1], self._recv_exactly(length - 4)
+
+    def _send_message(self, msg_type, payload):
+        self._sock.sendall(
+            msg_type + self._pack_int32(len(payload) + 4) + payload
+        )
+
+    @staticmethod
+    def _raise_error(payload):
+        fields = {}
+        for field in payload.split(b"\0"):
+            if field:
+                fields[field[:1]] = field[1:].decode("utf8", "replace")
+        raise DatabaseError(
+            fields.get(b"M", "Unknown error"),
+            fields.get(b"C"),
+        )
+
+    def _authenticate(self):
+        while True:
+            msg_type, payload = self._read_message()
+            if msg_type == b"E":
+                self._raise_error(payload)
+            if msg_type != b"R":
+                raise DatabaseError(
+                    "Unexpected message {!r} during authentication".format(
+                        msg_type
+                    )
+                )
+
+            code = self._unpack_int(payload)
+            if code == 0:
+                return
+
+            password = (self._uri.password or "").encode("utf8")
+            if code == 3:
+                self._send_message(b"p", password + b"\0")
+            elif code == 5:
+                import hashlib
+
+                user = (self._uri.user or "").encode("utf8")
+                inner = hashlib.md5(password + user).hexdigest()
+                outer = hashlib.md5(inner.encode("ascii") + payload[4:8])
+                self._send_message(
+                    b"p",
+                    b"md5" + outer.hexdigest().encode("ascii") + b"\0",
+                )
+            else:
+                raise DatabaseError(
+                    "Unsupported authentication method {}. Use the psycopg2 "
+                    "or psycopg driver instead".format(code)
+                )
+
+    def _read_until_ready(self):
+        rows = []
+        error = None
+        copy_out = False
+        while True:
+            msg_type, payload = self._read_message()
+            if msg_type == b"D":
+                rows.append(payload)
+            elif msg_type == b"E":
+                # The server always sends ReadyForQuery after an error, so we
+                # must consume it before raising
+                error = payload
+            elif msg_type in (b"G", b"W"):
+                # The server waits for COPY data that we have no way of
+                # providing, so abort it. It answers with an error.
+                self._send_message(
+                    b"f",
+                    b"COPY FROM STDIN is not supported by the built-in "
+                    b"driver\0",
+                )
+            elif msg_type == b"H":
+                # CopyData and CopyDone messages that follow are skipped by
+                # this loop
+                copy_out = True
+            elif msg_type == b"Z":
+                break
+
+        if error is not None:
+            self._raise_error(error)
+        if copy_out:
+            raise DatabaseError(
+                "COPY TO STDOUT is not supported by the built-in driver"
+            )
+
+        # Rows are only decoded once ReadyForQuery has been read, so a value
+        # that isn't valid UTF-8 doesn't leave the connection out of sync
+        return [self._parse_row(payload) for payload in rows]
+
+    def _parse_row(self, payload):
+        num_cols = self._unpack_int(payload, "!h")
+        offset = 2
+        row = []
+        for _ in range(num_cols):
+            length = self._unpack_int(payload, offset=offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+                continue
+            row.append(payload[offset:offset + length].decode("utf8"))
+            offset += length
+        return tuple(row)
+
+    def execute(self, sql):
+        """
+        Run the given SQL using the simple query protocol. All values are
+        returned as strings.
+        """
+        self._send_message(b"Q", sql.encode("utf8") + b"\0")
+        return self._read_until_ready()
+
+    def close(self):
+        # Don't end the session if the socket was inherited through fork,
+        # since it belongs to the parent
+        if os.getpid() == self._pid:
+            try:
+                self._send_message(b"X", b"")
+            except (IOError, OSError):
+                pass
+        self._sock.close()
+
+
+_drivers = [Psycopg2Driver, PsycopgDriver, BuiltinDriver]
+
+
+def get_driver(name=None):
+    """
+    Return a driver instance for the control connection of a cluster.
+
+    If no name is given, a driver whose library is already imported is
+    preferred since it's free to use. Otherwise the built-in driver is used to
+    avoid the import cost of a full client library.
+
+    :param name: ``"psycopg2"``, ``"psycopg"``, ``"builtin"`` or ``None``
+    :return: A driver instance
+    """
+    if name is not None:
+        for driver in _drivers:
+            if driver.name == name:
+                if not driver.is_available():
+                    raise ValueError(
+                        "The driver {!r} is not installed".format(name)
+                    )
+                return driver()
+        raise ValueError("Unknown driver {!r}".format(name))
+
+    for driver in _drivers:
+        if driver.is_loaded():
+            return driver()
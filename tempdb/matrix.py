@@ -0,0 +1,142 @@
+import os
+
+from collections import OrderedDict
+
+from ._compat import bstr, ustr
+from .discover import find_postgres_bin_dir, iter_postgres_bin_dirs
+from .postgres import PostgresFactory
+from .utils import get_version, Version
+
+
+__all__ = [
+    "ClusterMatrix",
+]
+
+
+def _to_version(version):
+    if isinstance(version, (bstr, ustr)):
+        return Version.from_str(version)
+    elif isinstance(version, int):
+        return Version(version)
+    return version
+
+
+class ClusterMatrix(object):
+    """
+    Run one temporary cluster for each of several PostgreSQL versions.
+
+    All clusters are started concurrently in the background as soon as
+    :meth:`start` is called. :meth:`get` only blocks until the cluster for the
+    requested version is running, so tests for one version can run while the
+    clusters for the other versions are still starting.
+
+    :param versions: Versions to start clusters for. Each entry may be a
+                     version string, number or Version object. All versions
+                     that can be discovered are used by default.
+    :param superuser: Name of the superuser. Defaults to the current user.
+    :param driver: Driver for the control connection of the clusters
+    :param jobs: Maximum number of clusters to start at the same time. By
+                 default all clusters are started at once.
+    """
+
+    def __init__(self, versions=None, superuser=None, driver=None, jobs=None):
+        self.superuser = superuser
+        self.driver = driver
+        self.jobs = jobs
+
+        self.bin_dirs = OrderedDict()
+        if versions is None:
+            for d, v in sorted(iter_postgres_bin_dirs(), key=lambda x: x[1]):
+                self.bin_dirs.setdefault(v, d)
+        else:
+            for v in versions:
+                d = find_postgres_bin_dir(_to_version(v))
+                if d is None:
+                    raise ValueError(
+                        "Unable to find PostgreSQL version {}".format(v)
+                    )
+
+                # Key by the installed version, like discovery does, so
+                # lookups work the same either way
+                self.bin_dirs.setdefault(
+                    get_version(os.path.join(d, "postgres")),
+                    d,
+                )
+
+        self._pool = None
+        self._results = None
+
+    @property
+    def versions(self):
+        return list(self.bin_dirs)
+
+    def __iter__(self):
+        return iter(self.bin_dirs)
+
+    def __len__(self):
+        return len(self.bin_dirs)
+
+    def _start_cluster(self, bin_dir):
+        factory = PostgresFactory(bin_dir, self.superuser, self.driver)
+        return factory.create_temporary_cluster()
+
+    def start(self):
+        """
+        Start creating the clusters for all versions in the background. Calling
+        this more than once has no effect.
+        """
+        if self._results is not None:
+            return self
+
+        # Starting a cluster is mostly spent waiting for initdb and the
+        # postmaster, so threads are enough to run them in parallel
+        from multiprocessing.pool import ThreadPool
+
+        self._pool = ThreadPool(self.jobs or max(len(self.bin_dirs), 1))
+        self._results = OrderedDict(
+            (v, self._pool.apply_async(self._start_cluster, (d,)))
+            for v, d in self.bin_dirs.items()
+        )
+        return self
+
+    def get(self, version):
+        """
+        Return the running cluster for the given version, waiting for it to
+        start if necessary.
+
+        :param version: Version string, number or Version object matching one
+                        of the versions in :attr:`versions`
+        :return: A :class:`~tempdb.PostgresCluster`
+        """
+        return self.start()._results[self._find_version(version)].get()
+
+    def _find_version(self, version):
+        """
+        Return the version in :attr:`versions` that matches the given version
+        string, number or Version object. Partial versions like ``"16"``
+        match any installed 16.x release.
+        """
+        version = _to_version(version)
+        for v in self.bin_dirs:
+            if version in v.iter_variants():
+                return v
+        raise KeyError("No cluster for version {}".format(version))
+
+    def close(self):
+        """Close all clusters, including those that are still starting"""
+        if self._results is None:
+            return
+
+        try:
+            for result in self._results.values():
+                try:
+                    cluster = result.get()
+                except Exception:
+                    # Clusters that failed to start have nothing to close
+                    continue
+                cluster.close()
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._results = None
@@ -0,0 +1,280 @@
+import os
+import sys
+import time
+import weakref
+
+from collections import namedtuple
+
+
+__all__ = [
+    "get_resource_usage",
+    "ResourceSampler",
+    "ResourceUsage",
+]
+
+
+_PROC = "/proc"
+
+
+class ResourceUsage(namedtuple("ResourceUsage", [
+    "timestamp",
+    "processes",
+    "rss",
+    "pss",
+    "cpu_time",
+    "open_files",
+    "data_dir_size",
+])):
+    """
+    Snapshot of the resources used by a cluster at a point in time.
+
+    Memory and disk figures are in bytes and CPU time is in seconds. ``rss`` is
+    the sum of the resident set size of every process and therefore counts
+    shared buffers once per backend. ``pss`` splits shared pages between the
+    processes mapping them, which makes it the better measure of the actual
+    memory footprint. It is ``None`` if the kernel doesn't expose it.
+    """
+    __slots__ = ()
+
+    def peak(self, other):
+        """
+        Return a new snapshot that contains the highest value of every field in
+        this snapshot and ``other``.
+        """
+        if other is None:
+            return self
+        return ResourceUsage(*(
+            _max_or_none(a, b) for a, b in zip(self, other)
+        ))
+
+
+def _max_or_none(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+def _read_proc_file(pid, name):
+    with open(os.path.join(_PROC, str(pid), name)) as f:
+        return f.read()
+
+
+def _parse_stat(pid):
+    """Return ``(ppid, utime, stime)`` from /proc/<pid>/stat"""
+    stat = _read_proc_file(pid, "stat")
+
+    # The command name is enclosed in parenthesis and may contain spaces, so
+    # we only split what comes after it
+    fields = stat[stat.rindex(")") + 2:].split()
+    return int(fields[1]), int(fields[11]), int(fields[12])
+
+
+def _read_kib_field(pid, name, field):
+    try:
+        content = _read_proc_file(pid, name)
+    except (IOError, OSError):
+        return None
+
+    for line in content.splitlines():
+        if line.startswith(field + ":"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def _read_children(pid):
+    """Return the PIDs of the children of every thread of ``pid``"""
+    task_dir = os.path.join(_PROC, str(pid), "task")
+    children = []
+    for tid in os.listdir(task_dir):
+        with open(os.path.join(task_dir, tid, "children")) as f:
+            children.extend(int(c) for c in f.read().split())
+    return children
+
+
+def _scan_process_table():
+    """Return a dict mapping each PID on the system to its children"""
+    children = {}
+    for entry in os.listdir(_PROC):
+        if not entry.isdigit():
+            continue
+        try:
+            ppid = _parse_stat(entry)[0]
+        except (IOError, OSError, ValueError, IndexError):
+            # The process exited while we were looking at it
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+
+def get_process_tree(pid):
+    """
+    Return a list of the given PID and the PIDs of all its descendants.
+
+    :param pid: PID of the root process
+    :return: List of PIDs, starting with ``pid``
+    """
+    pids = [pid]
+
+    # Reading the children of the tree directly avoids looking at every
+    # process on the system, but requires a kernel with CONFIG_PROC_CHILDREN
+    root_children = os.path.join(_PROC, str(pid), "task", str(pid), "children")
+    if not os.path.exists(root_children):
+        children = _scan_process_table()
+        for p in pids:
+            pids.extend(children.get(p, []))
+        return pids
+
+    for p in pids:
+        try:
+            pids.extend(_read_children(p))
+        except (IOError, OSError, ValueError):
+            # The process exited while we were looking at it
+            continue
+    return pids
+
+
+def get_dir_size(path):
+    """Return the number of bytes used by all files below ``path``"""
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                # Files may be removed by postgres while we walk the tree
+                pass
+    return size
+
+
+def get_resource_usage(pid, data_dir):
+    """
+    Sample the resource usage of the process tree rooted at ``pid`` and the
+    size of ``data_dir``.
+
+    :param pid: PID of the postmaster
+    :param data_dir: Data directory of the cluster
+    :return: A :class:`ResourceUsage` instance
+    """
+    if not sys.platform.startswith("linux"):
+        raise RuntimeError(
+            "Resource usage is only supported on Linux, not {!r}".format(
+                sys.platform
+            )
+        )
+
+    ticks_per_second = float(os.sysconf("SC_CLK_TCK"))
+
+    processes = 0
+    rss = 0
+    pss = None
+    cpu_time = 0.0
+    open_files = 0
+    for p in get_process_tree(pid):
+        try:
+            _, utime, stime = _parse_stat(p)
+            num_fds = len(os.listdir(os.path.join(_PROC, str(p), "fd")))
+        except (IOError, OSError):
+            # The backend exited after we listed it
+            continue
+
+        processes += 1
+        cpu_time += (utime + stime) / ticks_per_second
+        open_files += num_fds
+        rss += _read_kib_field(p, "status", "VmRSS") or 0
+
+        # smaps_rollup is only available on Linux 4.14 and later
+        p_pss = _read_kib_field(p, "smaps_rollup", "Pss")
+        if p_pss is not None:
+            pss = (pss or 0) + p_pss
+
+    return ResourceUsage(
+        timestamp=time.time(),
+        processes=processes,
+        rss=rss,
+        pss=pss,
+        cpu_time=cpu_time,
+        open_files=open_files,
+        data_dir_size=get_dir_size(data_dir),
+    )
+
+
+class ResourceSampler(object):
+    """
+    Background thread that periodically samples the resource usage of a
+    cluster.
+
+    :param cluster: The :class:`~tempdb.PostgresCluster` to monitor
+    :param interval: Number of seconds between samples
+    :param keep_samples: Store every sample in :attr:`samples` rather than just
+                         tracking the peak values
+    """
+
+    def __init__(self, cluster, interval=1.0, keep_samples=False):
+        import threading
+
+        # Only keep a weak reference so a forgotten sampler doesn't keep the
+        # cluster from being closed when it's garbage collected
+        self._cluster = weakref.ref(cluster)
+        self.interval = interval
+        self.keep_samples = keep_samples
+
+        self.samples = []
+        self.peak = None
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def sample(self):
+        """
+        Take a sample right away and record it.
+
+        :return: The new :class:`ResourceUsage` sample
+        """
+        cluster = self._cluster()
+        if cluster is None:
+            raise RuntimeError("The cluster has been garbage collected")
+
+        usage = cluster.resource_usage()
+        with self._lock:
+            self.peak = usage.peak(self.peak)
+            if self.keep_samples:
+                self.samples.append(usage)
+        return usage
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except (IOError, OSError):
+                # The cluster is most likely shutting down
+                pass
+            except RuntimeError:
+                break
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        """
+        Stop the sampler and wait for the background thread to finish.
+
+        :return: The peak :class:`ResourceUsage` seen while running
+        """
+        import threading
+
+        self._stop.set()
+
+        # The cluster may be garbage collected, and thereby closed, on the
+        # sampler thread itself. It stops on its own once the flag is set.
+        if threading.current_thread() is self._thread:
+            return self.peak
+
+        if self._thread.is_alive():
+            self._thread.join()
+        return self.peak
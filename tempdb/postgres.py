@@ -1,29 +1,73 @@
-import getpass
 import os
-import platform
-import psycopg2
-import sys
-import tempfile
-
-from glob import glob
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, quote_ident
-from subprocess import check_output, PIPE, Popen
+
 from time import sleep
 
+from . import _reset
 from ._compat import ustr
-from .utils import is_executable, Uri, Version
+from .drivers import get_driver
+from .monitor import get_resource_usage, ResourceSampler
+from .reaper import DATA_DIR, MARKER_FILE, TEMP_PREFIX, write_marker
+from .utils import get_version, is_executable, quote_ident, Uri
 
 
 __all__ = [
+    "ClusterHandle",
     "PostgresFactory",
     "PostgresCluster",
 ]
 
+
+def _make_temporary_dir():
+    """
+    Create a directory for a temporary cluster, tagged with our PID so reap()
+    can remove it if we die without closing the cluster.
+
+    :return: Path of the data directory within it, which doesn't exist yet
+    """
+    import tempfile
+
+    cluster_dir = tempfile.mkdtemp(prefix=TEMP_PREFIX)
+    write_marker(cluster_dir)
+    return os.path.join(cluster_dir, DATA_DIR)
+
+
 class PostgresFactory(object):
-    def __init__(self, pg_bin_dir, superuser=None):
+    """
+    Factory for clusters running a particular PostgreSQL installation.
+
+    :param pg_bin_dir: Directory containing the ``initdb`` and ``postgres``
+                       binaries
+    :param superuser: Name of the superuser. Defaults to the current user.
+    :param driver: Name of the driver used for the superuser control
+                   connection of clusters. See :func:`~tempdb.get_driver`.
+    :param extensions: Extensions to install in the template of temporary
+                       clusters
+    :param setup_sql: SQL to run in the template of temporary clusters after
+                      the extensions have been installed
+    :param template: Name of the template database to prepare. It's created
+                     if it isn't ``template1``.
+    """
+
+    def __init__(
+        self,
+        pg_bin_dir,
+        superuser=None,
+        driver=None,
+        extensions=None,
+        setup_sql=None,
+        template="template1",
+    ):
         # Temporary value until the first time we request it
         self._version = None
 
+        # Prepared data directories by (extensions, setup_sql, template). The
+        # lock is needed since lazy clusters may prepare them in the
+        # background.
+        import threading
+        self._golden_dirs = {}
+        self._golden_lock = threading.Lock()
+        self._owner_pid = os.getpid()
+
         self.initdb = os.path.join(pg_bin_dir, "initdb")
         if not is_executable(self.initdb):
             raise ValueError(
@@ -37,8 +81,16 @@ class PostgresFactory(object):
             )
 
         if superuser is None:
+            import getpass
             superuser = getpass.getuser()
         self.superuser = superuser
+        self.driver = driver
+        self.extensions = extensions
+        self.setup_sql = setup_sql
+        self.template = template
+
+    def __del__(self):
+        self.close()
 
     @property
     def version(self):
@@ -56,11 +108,16 @@ class PostgresFactory(object):
                          be automatically created if necessary.
         :return: Path to the created cluster that can be used by load_cluster()
         """
+        # Subprocess and tempfile are imported on demand to keep importing
+        # tempdb cheap
+        import tempfile
+        from subprocess import check_output
+
         if data_dir is None:
             data_dir = tempfile.mkdtemp()
 
         # If the target directory is not empty we don't want to risk wiping it
-        if os.listdir(data_dir):
+        if os.path.exists(data_dir) and os.listdir(data_dir):
             raise ValueError((
                 "The given data directory {} is not empty. A new cluster will "
                 "not be created."
@@ -75,16 +132,135 @@ class PostgresFactory(object):
 
         return data_dir
 
-    def create_temporary_cluster(self):
-        data_dir = self.init_cluster()
+    def _setup_template(self, data_dir, extensions, setup_sql, template):
+        """Apply the extensions and setup SQL to the template in data_dir"""
+        cluster = self.load_cluster(
+            data_dir,
+            fsync=False,
+            full_page_writes=False,
+        )
+        try:
+            if template != "template1":
+                cluster.create_database(template)
+                cluster.conn.execute(
+                    "ALTER DATABASE {} IS_TEMPLATE true".format(
+                        quote_ident(template)
+                    )
+                )
+
+            uri = cluster.uri.replace(database=template)
+            conn = cluster.driver.connect(uri)
+            try:
+                for extension in extensions:
+                    conn.execute("CREATE EXTENSION IF NOT EXISTS {}".format(
+                        quote_ident(extension)
+                    ))
+                if setup_sql:
+                    conn.execute(setup_sql)
+            finally:
+                conn.close()
+        finally:
+            # The postmaster performs a shutdown checkpoint when closing, so
+            # the data directory is consistent and safe to copy
+            cluster.close()
+
+    def _prepare_golden_dir(self, extensions, setup_sql, template):
+        """
+        Create a stopped cluster where the given extensions and setup SQL have
+        been applied to the template. It's used as a source for new clusters
+        instead of running initdb.
+        """
+        data_dir = _make_temporary_dir()
+        try:
+            self.init_cluster(data_dir)
+            self._setup_template(data_dir, extensions, setup_sql, template)
+        except Exception:
+            # The directory isn't cached yet, so nothing else would remove it
+            import shutil
+            shutil.rmtree(os.path.dirname(data_dir), ignore_errors=True)
+            raise
+
+        return data_dir
+
+    def _init_temporary_data_dir(
+        self,
+        data_dir,
+        extensions,
+        setup_sql,
+        template,
+    ):
+        if extensions or setup_sql:
+            import shutil
+
+            key = (tuple(extensions or ()), setup_sql, template)
+            with self._golden_lock:
+                if key not in self._golden_dirs:
+                    self._golden_dirs[key] = self._prepare_golden_dir(*key)
+
+            shutil.copytree(self._golden_dirs[key], data_dir)
+        else:
+            self.init_cluster(data_dir)
+
+    def create_temporary_cluster(
+        self,
+        extensions=None,
+        setup_sql=None,
+        template=None,
+        lazy=False,
+        prefetch=False,
+    ):
+        """
+        Create and start a cluster that is removed when closed.
+
+        If any extensions or setup SQL are given, either here or to the
+        factory, they are applied to the template once. The result is cached
+        and copied for every following cluster with the same configuration,
+        which is faster than running initdb.
+
+        :param extensions: Extensions to install. Overrides the factory's.
+        :param setup_sql: SQL to run after installing extensions. Overrides
+                          the factory's.
+        :param template: Template database to prepare. Overrides the
+                         factory's.
+        :param lazy: Don't create the data directory or start the postmaster
+                     until the cluster is first used
+        :param prefetch: Create the data directory of a lazy cluster in a
+                         background thread right away
+        :return: A :class:`PostgresCluster`
+        """
+        if extensions is None:
+            extensions = self.extensions
+        if setup_sql is None:
+            setup_sql = self.setup_sql
+        if template is None:
+            template = self.template
+
+        # The directory is created and tagged up front so the cluster's URI
+        # is known, and reap() can remove it, even if the data directory isn't
+        # initialized until later
+        data_dir = _make_temporary_dir()
+
+        init = _InitTask(
+            self._init_temporary_data_dir,
+            (data_dir, extensions, setup_sql, template),
+            background=lazy and prefetch,
+        )
 
         # Since we know this database should never be loaded again we disable
         # safe guards Postgres has to prevent data corruption
-        return self.load_cluster(
-            data_dir,
+        uri = Uri(
+            scheme="postgresql",
+            user=self.superuser,
+            host=data_dir,
+            params={"fsync": False, "full_page_writes": False},
+        )
+        return PostgresCluster(
+            self.postgres,
+            uri,
             is_temporary=True,
-            fsync=False,
-            full_page_writes=False,
+            driver=self.driver,
+            lazy=lazy,
+            init=init,
         )
 
     def load_cluster(self, data_dir, is_temporary=False, **params):
@@ -94,28 +270,262 @@ class PostgresFactory(object):
             host=data_dir,
             params=params,
         )
-        return PostgresCluster(self.postgres, uri, is_temporary)
+        return PostgresCluster(self.postgres, uri, is_temporary, self.driver)
+
+    def close(self):
+        """Remove the cached template data directories"""
+        if not self._golden_dirs or os.getpid() != self._owner_pid:
+            return
+
+        import shutil
+
+        while self._golden_dirs:
+            _, data_dir = self._golden_dirs.popitem()
+            shutil.rmtree(os.path.dirname(data_dir), ignore_errors=True)
+
+
+class _InitTask(object):
+    """
+    Deferred initialization of a data directory, optionally running in a
+    background thread from the start.
+    """
+
+    def __init__(self, func, args, background=False):
+        self._func = func
+        self._args = args
+        self._done = False
+        self._error = None
+        self._thread = None
+
+        if background:
+            import threading
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        try:
+            self._func(*self._args)
+        except Exception as e:
+            self._error = e
+        self._done = True
+
+    def run(self):
+        """Make sure the initialization has finished, running it if needed"""
+        if self._thread is not None:
+            self._thread.join()
+        elif not self._done:
+            self._run()
+
+        if self._error is not None:
+            raise self._error
+
+    def wait(self):
+        """Wait for background initialization without starting it"""
+        if self._thread is not None:
+            self._thread.join()
+
+
+class ClusterHandle(object):
+    """
+    Lightweight reference to a running cluster that can be shared with other
+    processes, either by pickling it or by inheriting it through fork.
+
+    The handle only carries the URI of the cluster. Its control connection is
+    opened on first use and reopened if the handle is used in a forked child.
+    Closing a handle never stops the cluster.
+
+    :param uri: URI of the cluster
+    :param driver: Name of the driver to use for the control connection
+    """
+
+    def __init__(self, uri, driver=None):
+        self.uri = uri
+        self.driver_name = driver
+        self._conn = None
+        self._conn_pid = None
+
+    def __getstate__(self):
+        return {"uri": ustr(self.uri), "driver": self.driver_name}
+
+    def __setstate__(self, state):
+        self.__init__(Uri.parse(state["uri"]), state["driver"])
+
+    def _connect(self):
+        return get_driver(self.driver_name).connect(
+            self.uri.replace(database="postgres")
+        )
+
+    @property
+    def conn(self):
+        """
+        Superuser control connection for the current process. It's created
+        lazily and replaced after a fork.
+        """
+        pid = os.getpid()
+        if self._conn is not None and self._conn_pid != pid:
+            # The connection was inherited through fork and belongs to the
+            # parent. Closing it explicitly would end the parent's session,
+            # so it's dropped instead. Neither the drivers nor the libraries
+            # they wrap end the session when garbage collected in a child.
+            self._conn = None
+
+        if self._conn is None:
+            self._conn = self._connect()
+            self._conn_pid = pid
+        return self._conn
+
+    def handle(self):
+        """Return a :class:`ClusterHandle` that can be passed to children"""
+        # Replacing nothing leaves out the server settings, which are only
+        # needed to start the postmaster
+        return ClusterHandle(self.uri.replace(), self.driver_name)
+
+    def _iter_all_databases(self):
+        for name, in self.conn.execute("SELECT datname FROM pg_database"):
+            yield name
+
+    def iter_databases(self):
+        """
+        Iterate over the names of the user databases. Template databases,
+        like the one prepared by the factory, aren't included.
+        """
+        sql = "SELECT datname FROM pg_database WHERE NOT datistemplate"
+        for name, in self.conn.execute(sql):
+            if name != "postgres":
+                yield name
+
+    def create_database(self, name, template=None):
+        if name in self._iter_all_databases():
+            raise KeyError("The database {!r} already exists".format(name))
+
+        sql = "CREATE DATABASE {}".format(quote_ident(name))
+        if template is not None:
+            sql += " TEMPLATE {}".format(quote_ident(template))
 
+        self.conn.execute(sql)
+
+        return PostgresDatabase(self, self.uri.replace(database=name))
+
+    def get_database(self, name):
+        if name not in self._iter_all_databases():
+            raise KeyError("The database {!r} doesn't exist".format(name))
+        return PostgresDatabase(self, self.uri.replace(database=name))
 
-class PostgresCluster(object):
-    def __init__(self, postgres_bin, uri, is_temporary=False):
+    def close(self):
+        """
+        Close the control connection if it was opened by this process. An
+        inherited connection is dropped without closing it, see :attr:`conn`.
+        """
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+class PostgresCluster(ClusterHandle):
+    """
+    A running PostgreSQL cluster.
+
+    :param postgres_bin: Path to the postgres binary
+    :param uri: URI of the cluster. The host must be the data directory, which
+                is also used for the UNIX socket. Parameters are passed to
+                postgres as configuration.
+    :param is_temporary: Remove the data directory when the cluster is closed
+    :param driver: Name of the driver to use for the control connection
+    :param lazy: Don't start the postmaster until the cluster is first used
+    :param init: Initialization of the data directory that must finish before
+                 the postmaster is started
+    """
+
+    def __init__(
+        self,
+        postgres_bin,
+        uri,
+        is_temporary=False,
+        driver=None,
+        lazy=False,
+        init=None,
+    ):
         if uri.host is None or not uri.host.startswith("/"):
             msg = "{!r} doesn't point to a UNIX socket directory"
             raise ValueError(msg.format(uri))
 
-        self.uri = uri
+        import threading
+
+        super(PostgresCluster, self).__init__(uri, driver)
+        self.postgres_bin = postgres_bin
         self.is_temporary = is_temporary
+        self.driver = None
+        self.process = None
         self.returncode = None
+        self.peak_usage = None
+        self._sampler = None
+        self._init = init
+        self._closed = False
+
+        # Serializes starting a lazy cluster, which may first be used by
+        # several threads at once, and closing it before it's started
+        self._start_lock = threading.Lock()
+
+        # Only the process that started the postmaster may stop it
+        self.owner_pid = os.getpid()
+
+        if not lazy:
+            try:
+                self.start()
+            except Exception:
+                # Nobody gets a reference to close, so stop the postmaster, if
+                # it got that far, and remove the data directory right away
+                if self.process is not None:
+                    self.process.kill()
+                    self.process.wait()
+                    self.process = None
+                self.close()
+                raise
+
+    @property
+    def is_running(self):
+        return self.process is not None
+
+    def start(self):
+        """
+        Start the postmaster unless it's already running. This is done
+        automatically when a lazy cluster is first used.
+        """
+        if self.process is not None:
+            return self
+
+        if os.getpid() != self.owner_pid:
+            raise RuntimeError(
+                "A lazy cluster must be started by the process that created it"
+            )
+
+        with self._start_lock:
+            # Another thread may have started the cluster while we waited
+            if self.process is None:
+                self._start()
+        return self
+
+    def _start(self):
+        if self._closed:
+            raise RuntimeError("The cluster has been closed")
+
+        from glob import glob
+        from subprocess import PIPE, Popen
+
+        if self._init is not None:
+            self._init.run()
+            self._init = None
 
         cmd = [
-            postgres_bin,
-            "-D", uri.host,
-            "-k", uri.host,
+            self.postgres_bin,
+            "-D", self.uri.host,
+            "-k", self.uri.host,
             "-c", "listen_addresses=",
         ]
 
         # Add additional configuration from kwargs
-        for k, v in uri.params.items():
+        for k, v in self.uri.params.items():
             if isinstance(v, bool):
                 v = "on" if v else "off"
             cmd.extend(["-c", "{}={}".format(k, v)])
@@ -128,63 +538,122 @@ class PostgresCluster(object):
         )
 
         # Wait for a ".s.PGSQL.<id>" file to appear before continuing
-        while not glob(os.path.join(uri.host, ".s.PGSQL.*")):
+        while not glob(os.path.join(self.uri.host, ".s.PGSQL.*")):
             sleep(0.1)
 
-        # Superuser connection
-        self.conn = psycopg2.connect(
-            ustr(self.uri.replace(database="postgres"))
-        )
-        self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        # Superuser connection. The driver is resolved here rather than at
+        # import time so that its library is only loaded when needed
+        self.driver = get_driver(self.driver_name)
+        self.driver_name = self.driver.name
+        self._conn = self._connect()
+        self._conn_pid = self.owner_pid
+
+    @property
+    def conn(self):
+        return super(PostgresCluster, self.start()).conn
+
+    @property
+    def dsn(self):
+        """DSN of the ``postgres`` database, which starts a lazy cluster"""
+        return ustr(self.start().uri.replace(database="postgres"))
+
+    def handle(self):
+        return super(PostgresCluster, self.start()).handle()
 
     def __del__(self):
         self.close()
 
-    def iter_databases(self):
-        with self.conn.cursor() as c:
-            default_databases = {"postgres", "template0", "template1"}
-            c.execute("SELECT datname FROM pg_database")
-            for name, in c:
-                if name not in default_databases:
-                    yield name
+    def __getstate__(self):
+        raise TypeError(
+            "PostgresCluster can't be pickled, use cluster.handle() instead"
+        )
 
-    def create_database(self, name, template=None):
-        if name in self.iter_databases():
-            raise KeyError("The database {!r} already exists".format(name))
+    def _connect(self):
+        return self.driver.connect(self.uri.replace(database="postgres"))
 
-        with self.conn.cursor() as c:
-            sql = "CREATE DATABASE {}".format(quote_ident(name, c))
-            if template is not None:
-                sql += " TEMPLATE {}".format(quote_ident(template, c))
+    def resource_usage(self):
+        """
+        Return the current resource usage of the postmaster, all its backends
+        and the data directory. This is only supported on Linux.
 
-            c.execute(sql)
+        :return: A :class:`~tempdb.ResourceUsage` instance
+        """
+        if self.process is None:
+            raise RuntimeError("The cluster is not running")
+        return get_resource_usage(self.process.pid, self.uri.host)
 
-        return PostgresDatabase(self, self.uri.replace(database=name))
+    def start_sampler(self, interval=1.0, keep_samples=False):
+        """
+        Start sampling resource usage in a background thread. The peak values
+        are available as :attr:`peak_usage` once the cluster is closed.
 
-    def get_database(self, name):
-        if name not in self.iter_databases():
-            raise KeyError("The database {!r} doesn't exist".format(name))
-        return PostgresDatabase(self, self.uri.replace(database=name))
+        :param interval: Number of seconds between samples
+        :param keep_samples: Keep every sample rather than just the peak
+        :return: The running :class:`~tempdb.ResourceSampler`
+        """
+        if self._sampler is not None:
+            raise RuntimeError("A sampler is already running for this cluster")
+        self.start()
+        self._sampler = ResourceSampler(self, interval, keep_samples).start()
+        return self._sampler
 
     def close(self):
-        if self.process is None:
+        # A forked child shares the postmaster with its parent, so it must
+        # only let go of its own control connection
+        if os.getpid() != self.owner_pid:
+            super(PostgresCluster, self).close()
             return
 
+        if self._closed:
+            return
+
+        if self.process is None:
+            with self._start_lock:
+                # A lazy cluster that was never started only has a, possibly
+                # empty, data directory to remove. Background initialization
+                # must finish first so it doesn't write to the directory
+                # afterwards.
+                if self.process is None:
+                    if self._init is not None:
+                        self._init.wait()
+                        self._init = None
+                    self._remove_temporary_data_dir()
+                    self._closed = True
+                    return
+
+        # Take a final sample before shutting down so short lived clusters
+        # still get a meaningful peak
+        if self._sampler is not None:
+            try:
+                self._sampler.sample()
+            except (IOError, OSError, RuntimeError):
+                # When closed by the garbage collector the sampler's weak
+                # reference to us may already be dead
+                pass
+            self.peak_usage = self._sampler.stop()
+            self._sampler = None
+
         # Kill all connections but this control connection. This prevents
         # the server waiting for connections to close indefinately
-        with self.conn.cursor() as c:
-            c.execute("""
-                SELECT pg_terminate_backend(pid)
-                FROM pg_stat_activity
-                WHERE pid != pg_backend_pid()
-            """)
-
-        self.conn.close()
+        self.conn.execute("""
+            SELECT pg_terminate_backend(pid)
+            FROM pg_stat_activity
+            WHERE pid != pg_backend_pid()
+        """)
+
+        super(PostgresCluster, self).close()
         self.process.terminate()
         self.returncode = self.process.wait()
+        self.process = None
 
-        # Remove temporary clusters when closing
-        if self.is_temporary:
+        self._remove_temporary_data_dir()
+        self._closed = True
+
+    def _remove_temporary_data_dir(self):
+        if not self.is_temporary:
+            return
+
+        if os.path.exists(self.uri.host):
             for path, dirs, files in os.walk(self.uri.host, topdown=False):
                 for f in files:
                     os.remove(os.path.join(path, f))
@@ -192,7 +661,13 @@ class PostgresCluster(object):
                     os.rmdir(os.path.join(path, d))
             os.rmdir(self.uri.host)
 
-        self.process = None
+        # Clusters from create_temporary_cluster() live in a directory of
+        # their own, next to the marker
+        cluster_dir = os.path.dirname(self.uri.host)
+        marker = os.path.join(cluster_dir, MARKER_FILE)
+        if os.path.exists(marker):
+            os.remove(marker)
+            os.rmdir(cluster_dir)
 
 
 class PostgresDatabase(object):
@@ -203,3 +678,38 @@ class PostgresDatabase(object):
     @property
     def dsn(self):
         return ustr(self.uri)
+
+    def _connect(self):
+        return get_driver(self.cluster.driver_name).connect(self.uri)
+
+    def track_changes(self):
+        """
+        Record the current contents of the database as the baseline that
+        :meth:`reset` restores, and install triggers that track which tables
+        are written to.
+
+        This is meant to be called on a template database once its schema and
+        fixtures are loaded. Databases created from it can then be reset. Only
+        tables that exist when this is called are tracked. Requires PostgreSQL
+        10 or later.
+        """
+        conn = self._connect()
+        try:
+            _reset.install_tracking(conn)
+        finally:
+            conn.close()
+
+    def reset(self):
+        """
+        Restore the baseline recorded by :meth:`track_changes`. Only tables
+        that have been written to, and tables referencing them, are truncated
+        and refilled. All sequences are reset to their baseline values.
+
+        Other connections to the database must not hold any locks on the
+        tables, or the reset will block until they are released.
+        """
+        conn = self._connect()
+        try:
+            _reset.reset(conn)
+        finally:
+            conn.close()
@@ -0,0 +1,60 @@
+import pytest
+
+from .matrix import ClusterMatrix
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("tempdb")
+    group.addoption(
+        "--pg-version",
+        action="append",
+        dest="pg_versions",
+        metavar="VERSION",
+        help=(
+            "PostgreSQL version to run pg_matrix_cluster tests against. May "
+            "be given multiple times. Defaults to all installed versions."
+        ),
+    )
+
+
+def _get_matrix(config):
+    matrix = getattr(config, "_tempdb_matrix", None)
+    if matrix is None:
+        matrix = ClusterMatrix(config.getoption("pg_versions"))
+        config._tempdb_matrix = matrix
+    return matrix
+
+
+def pytest_generate_tests(metafunc):
+    if "pg_matrix_cluster" not in metafunc.fixturenames:
+        return
+
+    matrix = _get_matrix(metafunc.config)
+    metafunc.parametrize(
+        "pg_matrix_cluster",
+        matrix.versions,
+        ids=[str(v) for v in matrix.versions],
+        indirect=True,
+        scope="session",
+    )
+
+
+def pytest_unconfigure(config):
+    matrix = getattr(config, "_tempdb_matrix", None)
+    if matrix is not None:
+        matrix.close()
+
+
+@pytest.fixture(scope="session")
+def pg_matrix(request):
+    """
+    The :class:`~tempdb.ClusterMatrix` for this session. All its clusters
+    start in the background the first time it's requested.
+    """
+    return _get_matrix(request.config).start()
+
+
+@pytest.fixture(scope="session")
+def pg_matrix_cluster(request, pg_matrix):
+    """A running cluster for the PostgreSQL version of the current test"""
+    return pg_matrix.get(request.param)
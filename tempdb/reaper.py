@@ -0,0 +1,256 @@
+import errno
+import os
+import sys
+import time
+
+
+__all__ = [
+    "reap",
+]
+
+
+#: Prefix of the directories temporary clusters are created in
+TEMP_PREFIX = "tempdb-"
+
+#: Name of the marker file that identifies the owner of a temporary cluster
+MARKER_FILE = "tempdb.json"
+
+#: Name of the data directory next to the marker. Keeping the marker outside
+#: the data directory means it's in place while initdb runs.
+DATA_DIR = "data"
+
+
+def write_marker(cluster_dir, pid=None):
+    """
+    Tag the given directory as a temporary cluster owned by ``pid``.
+
+    :param cluster_dir: Directory containing the data directory of the cluster
+    :param pid: PID of the owning process. Defaults to the current process.
+    """
+    import json
+
+    if pid is None:
+        pid = os.getpid()
+
+    with open(os.path.join(cluster_dir, MARKER_FILE), "w") as f:
+        json.dump({"pid": pid, "created": time.time()}, f)
+
+
+def read_marker(cluster_dir):
+    """
+    Return the ``(pid, created)`` pair stored in the marker file of
+    ``cluster_dir``, or ``None`` if there is no valid marker.
+    """
+    import json
+
+    try:
+        with open(os.path.join(cluster_dir, MARKER_FILE)) as f:
+            marker = json.load(f)
+        return int(marker["pid"]), float(marker["created"])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def read_postmaster_pid(data_dir):
+    """
+    Return the PID stored in the ``postmaster.pid`` file of ``data_dir``, or
+    ``None`` if the file is missing.
+    """
+    try:
+        with open(os.path.join(data_dir, "postmaster.pid")) as f:
+            return int(f.readline().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _get_boot_time():
+    with open("/proc/stat") as f:
+        for line in f:
+            if line.startswith("btime "):
+                return float(line.split()[1])
+    return None
+
+
+def _get_start_time(pid):
+    """
+    Return the time the given process started as a UNIX timestamp, or ``None``
+    if it can't be determined on this system.
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            stat = f.read()
+        boot_time = _get_boot_time()
+    except (IOError, OSError):
+        return None
+
+    if boot_time is None:
+        return None
+
+    # Skip past the command name since it may contain spaces
+    fields = stat[stat.rindex(")") + 2:].split()
+    return boot_time + int(fields[19]) / float(os.sysconf("SC_CLK_TCK"))
+
+
+def is_alive(pid, created=None):
+    """
+    Return True if a process with the given PID is running.
+
+    :param pid: PID to check
+    :param created: Time the process is known to have been running. If the
+                    process with the given PID started after this, the PID has
+                    been reused and the original process is considered dead.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        if e.errno != errno.EPERM:
+            raise
+
+    if created is not None:
+        start_time = _get_start_time(pid)
+
+        # The start time is only precise to the clock tick and the boot time
+        # to the second, so allow for some slack
+        if start_time is not None and start_time > created + 1:
+            return False
+
+    return True
+
+
+def _get_cmdline(pid):
+    """
+    Return the arguments of the given process as a list of bytes, or ``None``
+    if the process can't be inspected.
+    """
+    try:
+        with open("/proc/{}/cmdline".format(pid), "rb") as f:
+            return f.read().split(b"\0")
+    except (IOError, OSError):
+        pass
+
+    # Systems without /proc, like macOS
+    from subprocess import CalledProcessError, check_output
+
+    try:
+        return check_output(["ps", "-o", "command=", "-p", str(pid)]).split()
+    except (OSError, CalledProcessError):
+        return None
+
+
+def _is_postmaster(pid, data_dir):
+    """
+    Return True if the given process is a postmaster serving ``data_dir``.
+    Since tempdb always passes the data directory using ``-D``, this protects
+    against signalling an unrelated process that reused the PID of a stale
+    ``postmaster.pid``.
+    """
+    args = _get_cmdline(pid)
+    if not args:
+        return False
+
+    data_dirs = set()
+    for d in (data_dir, os.path.abspath(data_dir)):
+        if not isinstance(d, bytes):
+            d = d.encode(sys.getfilesystemencoding())
+        data_dirs.add(d)
+
+    return b"postgres" in args[0] and not data_dirs.isdisjoint(args)
+
+
+def iter_orphaned_clusters(temp_dir=None):
+    """
+    Find temporary clusters whose owning process is no longer running.
+
+    :param temp_dir: Directory to look for clusters in. Defaults to the
+                     system's temporary directory.
+    :return: An iterator of cluster directories, each containing the marker
+             and the data directory of a cluster
+    """
+    from glob import glob
+
+    if temp_dir is None:
+        import tempfile
+        temp_dir = tempfile.gettempdir()
+
+    for cluster_dir in glob(os.path.join(temp_dir, TEMP_PREFIX + "*")):
+        marker = read_marker(cluster_dir)
+        if marker is None:
+            continue
+
+        pid, created = marker
+        if not is_alive(pid, created):
+            yield cluster_dir
+
+
+def stop_postmaster(data_dir, timeout=10.0):
+    """
+    Stop the postmaster running in ``data_dir`` using immediate shutdown. If
+    it hasn't stopped within ``timeout`` seconds it is killed.
+
+    :param data_dir: Data directory of the cluster
+    :param timeout: Number of seconds to wait for postgres to shut down
+    :return: True if a running postmaster was stopped
+    """
+    import signal
+
+    pid = read_postmaster_pid(data_dir)
+    if pid is None or not is_alive(pid) or not _is_postmaster(pid, data_dir):
+        return False
+
+    # SIGQUIT triggers immediate shutdown, which skips the shutdown checkpoint
+    os.kill(pid, signal.SIGQUIT)
+
+    deadline = time.time() + timeout
+    while is_alive(pid):
+        if time.time() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            break
+        time.sleep(0.1)
+    return True
+
+
+def _reap_cluster(cluster_dir, timeout=10.0):
+    import shutil
+
+    try:
+        stop_postmaster(os.path.join(cluster_dir, DATA_DIR), timeout)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            raise
+        # The postmaster belongs to another user. Its data directory can't
+        # be removed while it's running, so the cluster is left alone.
+        return None
+
+    # Another reaper may be removing the same directory concurrently
+    shutil.rmtree(cluster_dir, ignore_errors=True)
+    return cluster_dir
+
+
+def reap(temp_dir=None, jobs=4, timeout=10.0, dry_run=False):
+    """
+    Stop and remove temporary clusters whose owning process has died, for
+    instance after a test run was killed. Clusters whose postmaster can't be
+    stopped, because it belongs to another user, are skipped.
+
+    :param temp_dir: Directory to look for clusters in. Defaults to the
+                     system's temporary directory.
+    :param jobs: Number of clusters to remove in parallel
+    :param timeout: Number of seconds to wait for each postmaster to shut down
+    :param dry_run: Only return the orphaned clusters without removing them
+    :return: List of cluster directories that were reaped
+    """
+    cluster_dirs = list(iter_orphaned_clusters(temp_dir))
+    if dry_run or not cluster_dirs:
+        return cluster_dirs
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(min(jobs, len(cluster_dirs)))
+    try:
+        reaped = pool.map(lambda d: _reap_cluster(d, timeout), cluster_dirs)
+    finally:
+        pool.close()
+        pool.join()
+    return [d for d in reaped if d is not None]
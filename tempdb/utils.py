@@ -2,7 +2,6 @@ import os
 import re
 
 from collections import OrderedDict
-from subprocess import check_output
 
 from ._compat import (
     bstr,
@@ -17,11 +16,14 @@ from ._compat import (
 __all__ = [
     "get_version",
     "is_executable",
+    "quote_ident",
     "Version",
 ]
 
 
 def get_version(postgres_path):
+    from subprocess import check_output
+
     version = check_output([postgres_path, "--version"]).decode("utf-8")
     try:
         return next(Version.iter_str(version))
@@ -42,6 +44,11 @@ def is_executable(path):
     return os.access(path, os.X_OK)
 
 
+def quote_ident(name):
+    """Quote the given string for use as an SQL identifier"""
+    return u'"{}"'.format(name.replace(u'"', u'""'))
+
+
 class Version(tuple):
     __slots__ = ()
 
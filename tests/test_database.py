@@ -1,7 +1,14 @@
+import gc
+import os
+import pickle
 import psycopg2
 import pytest
+import sys
 
+from contextlib import closing
 from tempdb import find_postgres_bin_dir, PostgresFactory
+from tempdb._compat import ustr
+from tempdb.drivers import BuiltinDriver, DatabaseError
 
 
 @pytest.fixture(scope="session")
@@ -38,6 +45,53 @@ def test_create_database(temp_cluster):
     assert list(temp_cluster.iter_databases()) == ["tmp"]
 
 
+@pytest.mark.parametrize("driver", ["builtin", "psycopg2"])
+def test_driver(pg_bin_dir, driver):
+    factory = PostgresFactory(pg_bin_dir, driver=driver)
+    cluster = factory.create_temporary_cluster()
+    try:
+        cluster.create_database("tmp")
+        assert list(cluster.iter_databases()) == ["tmp"]
+    finally:
+        cluster.close()
+
+
+def test_builtin_driver_copy(temp_cluster):
+    uri = temp_cluster.uri.replace(database="postgres")
+    conn = BuiltinDriver().connect(uri)
+    try:
+        conn.execute("CREATE TABLE x(id INTEGER)")
+        with pytest.raises(DatabaseError):
+            conn.execute("COPY x FROM STDIN")
+        with pytest.raises(DatabaseError):
+            conn.execute("COPY x TO STDOUT")
+
+        # The connection must still be usable afterwards
+        assert conn.execute("SELECT 1") == [("1",)]
+    finally:
+        conn.close()
+
+
+def test_builtin_driver_encoding(temp_cluster):
+    temp_cluster.conn.execute(
+        "CREATE DATABASE latin ENCODING 'LATIN1' LC_COLLATE 'C' LC_CTYPE 'C' "
+        "TEMPLATE template0"
+    )
+    db = temp_cluster.get_database("latin")
+    conn = psycopg2.connect(db.dsn)
+    conn.autocommit = True
+    with conn.cursor() as c:
+        c.execute("CREATE TABLE t(v TEXT)")
+        c.execute(u"INSERT INTO t VALUES ('caf\u00e9')")
+    conn.close()
+
+    conn = BuiltinDriver().connect(db.uri)
+    try:
+        assert conn.execute("SELECT v FROM t") == [(u"caf\u00e9",)]
+    finally:
+        conn.close()
+
+
 def test_get_database(temp_cluster):
     with pytest.raises(KeyError):
         temp_cluster.get_database("tmp")
@@ -63,3 +117,249 @@ def test_create_tables(conn):
             "Abel",
             "Cain",
         ]
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="Resource usage requires /proc",
+)
+def test_resource_usage(temp_cluster):
+    temp_cluster.start_sampler(interval=0.1)
+    usage = temp_cluster.resource_usage()
+    assert usage.processes > 1
+    assert usage.data_dir_size > 0
+
+    temp_cluster.close()
+    assert temp_cluster.peak_usage.rss >= usage.rss
+
+
+def test_handle_pickle(temp_cluster):
+    handle = pickle.loads(pickle.dumps(temp_cluster.handle()))
+    assert handle.uri.host == temp_cluster.uri.host
+    handle.create_database("tmp")
+    handle.close()
+    assert list(temp_cluster.iter_databases()) == ["tmp"]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Requires fork")
+@pytest.mark.parametrize("driver", ["builtin", "psycopg2"])
+def test_fork(pg_bin_dir, driver):
+    factory = PostgresFactory(pg_bin_dir, driver=driver)
+    with closing(factory.create_temporary_cluster()) as cluster:
+        handle = cluster.handle()
+        handle.create_database("parent")
+
+        pid = os.fork()
+        if pid == 0:
+            # Neither closing nor garbage collecting the inherited cluster and
+            # connections in the child may stop the cluster or end the
+            # parent's sessions
+            try:
+                handle.create_database("child")
+                handle.close()
+                cluster.close()
+                del handle, cluster
+                gc.collect()
+            finally:
+                os._exit(0)
+
+        os.waitpid(pid, 0)
+        assert cluster.process.poll() is None
+        assert sorted(handle.iter_databases()) == ["child", "parent"]
+        assert list(cluster.iter_databases())
+
+
+def test_reset(temp_cluster):
+    template = temp_cluster.create_database("template")
+    conn = psycopg2.connect(template.dsn)
+    conn.autocommit = True
+    with conn.cursor() as c:
+        c.execute("""
+            CREATE TABLE author(id SERIAL PRIMARY KEY, name VARCHAR);
+            CREATE TABLE book(
+                id SERIAL PRIMARY KEY,
+                author_id INTEGER REFERENCES author(id)
+            );
+            CREATE TABLE untouched(id INTEGER);
+            INSERT INTO author(name) VALUES ('Abel');
+            INSERT INTO book(author_id) VALUES (1);
+            INSERT INTO untouched VALUES (1);
+        """)
+    conn.close()
+    template.track_changes()
+
+    db = temp_cluster.create_database("tmp", template="template")
+    conn = psycopg2.connect(db.dsn)
+    conn.autocommit = True
+    with conn.cursor() as c:
+        c.execute("INSERT INTO author(name) VALUES ('Cain')")
+        c.execute("DELETE FROM book")
+        c.execute("SELECT count(*) FROM tempdb_reset.dirty_tables")
+        assert c.fetchone() == (2,)
+
+    db.reset()
+
+    with conn.cursor() as c:
+        c.execute("SELECT id, name FROM author")
+        assert c.fetchall() == [(1, "Abel")]
+        c.execute("SELECT id, author_id FROM book")
+        assert c.fetchall() == [(1, 1)]
+        c.execute("SELECT count(*) FROM untouched")
+        assert c.fetchone() == (1,)
+        c.execute("INSERT INTO author(name) VALUES ('Cain') RETURNING id")
+        assert c.fetchone() == (2,)
+        c.execute("SELECT count(*) FROM tempdb_reset.dirty_tables")
+        assert c.fetchone() == (1,)
+    conn.close()
+
+
+def test_reset_unsupported_version():
+    from tempdb._reset import install_tracking
+
+    class Connection(object):
+        def execute(self, sql):
+            assert sql == "SHOW server_version_num"
+            return [("90624",)]
+
+    with pytest.raises(RuntimeError):
+        install_tracking(Connection())
+
+
+def test_reset_as_other_role(temp_cluster):
+    db = temp_cluster.create_database("tmp")
+    conn = psycopg2.connect(db.dsn)
+    conn.autocommit = True
+    with conn.cursor() as c:
+        c.execute("""
+            CREATE ROLE app LOGIN;
+            CREATE TABLE a(id INTEGER);
+            GRANT ALL ON a TO app;
+        """)
+    conn.close()
+    db.track_changes()
+
+    conn = psycopg2.connect(ustr(db.uri.replace(user="app")))
+    conn.autocommit = True
+    with conn.cursor() as c:
+        c.execute("INSERT INTO a VALUES (1)")
+    conn.close()
+
+    db.reset()
+
+    conn = psycopg2.connect(db.dsn)
+    with conn.cursor() as c:
+        c.execute("SELECT count(*) FROM a")
+        assert c.fetchone() == (0,)
+    conn.close()
+
+
+def test_reset_partition(temp_cluster):
+    db = temp_cluster.create_database("tmp")
+    conn = psycopg2.connect(db.dsn)
+    conn.autocommit = True
+    with conn.cursor() as c:
+        c.execute("""
+            CREATE TABLE p(id INTEGER) PARTITION BY RANGE (id);
+            CREATE TABLE p1 PARTITION OF p FOR VALUES FROM (0) TO (10);
+            CREATE TABLE p2 PARTITION OF p FOR VALUES FROM (10) TO (20);
+            INSERT INTO p VALUES (1), (11);
+        """)
+    db.track_changes()
+
+    with conn.cursor() as c:
+        # Writing to a partition directly must be detected as well
+        c.execute("INSERT INTO p1 VALUES (2)")
+        c.execute("DELETE FROM p2")
+
+    db.reset()
+
+    with conn.cursor() as c:
+        c.execute("SELECT id FROM p ORDER BY id")
+        assert c.fetchall() == [(1,), (11,)]
+    conn.close()
+
+
+@pytest.mark.parametrize("template", ["template1", "golden"])
+def test_template_setup(pg_bin_dir, template):
+    factory = PostgresFactory(
+        pg_bin_dir,
+        extensions=["plpgsql"],
+        setup_sql="CREATE TABLE seed(id INTEGER); INSERT INTO seed VALUES (1)",
+        template=template,
+    )
+    try:
+        for _ in range(2):
+            with closing(factory.create_temporary_cluster()) as cluster:
+                assert list(cluster.iter_databases()) == []
+                assert cluster.get_database(template).uri.database == template
+                db = cluster.create_database("tmp", template=template)
+                conn = psycopg2.connect(db.dsn)
+                with conn.cursor() as c:
+                    c.execute("SELECT id FROM seed")
+                    assert c.fetchall() == [(1,)]
+                conn.close()
+        assert len(factory._golden_dirs) == 1
+    finally:
+        factory.close()
+    assert factory._golden_dirs == {}
+
+
+def test_template_setup_failure(pg_bin_dir, tmpdir, monkeypatch):
+    import tempfile
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+
+    factory = PostgresFactory(pg_bin_dir, setup_sql="SELECT invalid")
+    with pytest.raises(Exception):
+        factory.create_temporary_cluster()
+    assert factory._golden_dirs == {}
+    assert tmpdir.listdir() == []
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_lazy_cluster(factory, prefetch):
+    cluster = factory.create_temporary_cluster(lazy=True, prefetch=prefetch)
+    try:
+        assert not cluster.is_running
+        assert list(cluster.iter_databases()) == []
+        assert cluster.is_running
+        psycopg2.connect(cluster.dsn).close()
+    finally:
+        cluster.close()
+    assert not os.path.exists(cluster.uri.host)
+
+    with pytest.raises(RuntimeError):
+        cluster.create_database("tmp")
+
+
+def test_lazy_cluster_concurrent_start(factory, monkeypatch):
+    import subprocess
+    import threading
+
+    launches = []
+    popen = subprocess.Popen
+
+    def counting_popen(args, *rest, **kwargs):
+        if args[0] == factory.postgres:
+            launches.append(args)
+        return popen(args, *rest, **kwargs)
+    monkeypatch.setattr(subprocess, "Popen", counting_popen)
+
+    cluster = factory.create_temporary_cluster(lazy=True, prefetch=True)
+    try:
+        threads = [threading.Thread(target=cluster.start) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(launches) == 1
+        assert list(cluster.iter_databases()) == []
+    finally:
+        cluster.close()
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_lazy_cluster_unused(factory, prefetch):
+    cluster = factory.create_temporary_cluster(lazy=True, prefetch=prefetch)
+    cluster.close()
+    assert not cluster.is_running
+    assert not os.path.exists(cluster.uri.host)
@@ -0,0 +1,31 @@
+import pytest
+import subprocess
+import sys
+
+from tempdb.drivers import BuiltinDriver, get_driver
+from tempdb.utils import quote_ident
+
+
+def test_quote_ident():
+    assert quote_ident("tmp") == '"tmp"'
+    assert quote_ident('a"b') == '"a""b"'
+
+
+def test_get_driver():
+    assert isinstance(get_driver("builtin"), BuiltinDriver)
+
+
+def test_unknown_driver():
+    with pytest.raises(ValueError):
+        get_driver("nonexistent")
+
+
+def test_lazy_import():
+    code = (
+        "import sys, tempdb;"
+        "print(' '.join(m for m in ("
+        "'psycopg2', 'psycopg', 'subprocess', 'glob', 'json', 'signal'"
+        ") if m in sys.modules))"
+    )
+    out = subprocess.check_output([sys.executable, "-c", code])
+    assert out.strip() == b""
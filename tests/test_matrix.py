@@ -0,0 +1,60 @@
+import pytest
+import subprocess
+import sys
+
+from tempdb import ClusterMatrix, find_postgres_bin_dir
+
+
+@pytest.fixture(scope="module")
+def matrix():
+    if find_postgres_bin_dir() is None:
+        pytest.skip("Unable to locate a PostgreSQL installation")
+
+    m = ClusterMatrix()
+    try:
+        yield m.start()
+    finally:
+        m.close()
+
+
+def test_matrix(matrix):
+    assert len(matrix) > 0
+    for version in matrix:
+        cluster = matrix.get(version)
+        assert cluster.create_database("tmp").uri.database == "tmp"
+
+
+def test_get_by_partial_version(matrix):
+    version = matrix.versions[0]
+    cluster = matrix.get(version)
+    assert matrix.get(str(version.major)) is cluster
+    assert matrix.get(version.major) is cluster
+    assert matrix.get(str(version)) is cluster
+
+
+def test_requested_versions(matrix):
+    version = matrix.versions[0]
+    assert ClusterMatrix([str(version.major)]).versions == [version]
+
+
+def test_unknown_version(matrix):
+    with pytest.raises(KeyError):
+        matrix.get("1")
+
+    with pytest.raises(ValueError):
+        ClusterMatrix(["1"])
+
+
+def test_pytest_plugin(matrix, tmpdir):
+    tmpdir.join("test_plugin.py").write(
+        "def test_version(pg_matrix_cluster):\n"
+        "    assert list(pg_matrix_cluster.iter_databases()) == []\n"
+    )
+    out = subprocess.check_output([
+        sys.executable, "-m", "pytest",
+        "-p", "tempdb.pytest_plugin",
+        "-v",
+        str(tmpdir),
+    ])
+    for version in matrix:
+        assert "test_version[{}] PASSED".format(version).encode() in out
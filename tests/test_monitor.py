@@ -0,0 +1,104 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from tempdb.monitor import (
+    get_process_tree,
+    get_resource_usage,
+    ResourceSampler,
+    ResourceUsage,
+)
+
+
+linux_only = pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="Resource usage requires /proc",
+)
+
+
+def test_peak():
+    a = ResourceUsage(1, 2, 300, None, 1.5, 10, 1000)
+    b = ResourceUsage(2, 1, 200, 100, 2.5, 5, 2000)
+    assert a.peak(b) == ResourceUsage(2, 2, 300, 100, 2.5, 10, 2000)
+    assert a.peak(None) == a
+
+
+@linux_only
+def test_process_tree():
+    child = subprocess.Popen(
+        [sys.executable, "-c", "input()"],
+        stdin=subprocess.PIPE,
+    )
+    try:
+        pids = get_process_tree(os.getpid())
+        assert pids[0] == os.getpid()
+        assert child.pid in pids
+    finally:
+        child.communicate(b"\n")
+
+
+@linux_only
+def test_process_tree_fallback(monkeypatch):
+    # Kernels without CONFIG_PROC_CHILDREN need a scan of the process table
+    monkeypatch.setattr(os.path, "exists", lambda path: False)
+    child = subprocess.Popen(
+        [sys.executable, "-c", "input()"],
+        stdin=subprocess.PIPE,
+    )
+    try:
+        pids = get_process_tree(os.getpid())
+        assert pids[0] == os.getpid()
+        assert child.pid in pids
+    finally:
+        child.communicate(b"\n")
+
+
+def test_process_tree_children_file(tmpdir, monkeypatch):
+    # 1 has two threads, one of which started 3, and 2 started 4
+    for pid, tid, children in [
+        (1, 1, "2 "),
+        (1, 5, "3 "),
+        (2, 2, "4 "),
+        (3, 3, ""),
+        (4, 4, ""),
+    ]:
+        tmpdir.join(str(pid), "task", str(tid), "children").write(
+            children,
+            ensure=True,
+        )
+    monkeypatch.setattr("tempdb.monitor._PROC", str(tmpdir))
+    assert sorted(get_process_tree(1)) == [1, 2, 3, 4]
+
+
+@linux_only
+def test_resource_usage(tmpdir):
+    tmpdir.join("data").write("x" * 100)
+    usage = get_resource_usage(os.getpid(), str(tmpdir))
+    assert usage.processes >= 1
+    assert usage.rss > 0
+    assert usage.open_files > 0
+    assert usage.data_dir_size == 100
+
+
+def test_stop_from_sampler_thread():
+    # Mimics the cluster being garbage collected, and closed, on the sampler
+    # thread while it's taking a sample
+    class Cluster(object):
+        errors = []
+
+        def resource_usage(self):
+            try:
+                sampler.stop()
+            except Exception as e:
+                self.errors.append(e)
+            return ResourceUsage(0, 1, 1, None, 0.0, 1, 1)
+
+    cluster = Cluster()
+    sampler = ResourceSampler(cluster, interval=0.01)
+    sampler.start()
+    sampler._thread.join(5)
+
+    assert not sampler._thread.is_alive()
+    assert Cluster.errors == []
+    assert sampler.peak is not None
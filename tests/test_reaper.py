@@ -0,0 +1,164 @@
+import errno
+import os
+import pytest
+import signal
+import subprocess
+import sys
+import time
+
+from tempdb import find_postgres_bin_dir, PostgresFactory
+from tempdb.__main__ import main
+from tempdb.reaper import (
+    DATA_DIR,
+    is_alive,
+    read_marker,
+    reap,
+    TEMP_PREFIX,
+    write_marker,
+)
+
+
+def dead_pid():
+    p = subprocess.Popen([sys.executable, "-c", ""])
+    p.wait()
+    return p.pid
+
+
+def make_cluster_dir(tmpdir, name, pid):
+    d = tmpdir.mkdir(TEMP_PREFIX + name)
+    d.join(DATA_DIR, "PG_VERSION").write("11\n", ensure=True)
+    write_marker(str(d), pid)
+    return str(d)
+
+
+def test_is_alive():
+    assert is_alive(os.getpid())
+    assert not is_alive(dead_pid())
+
+
+def test_reap(tmpdir):
+    orphan = make_cluster_dir(tmpdir, "orphan", dead_pid())
+    owned = make_cluster_dir(tmpdir, "owned", os.getpid())
+    unmarked = str(tmpdir.mkdir(TEMP_PREFIX + "unmarked"))
+
+    assert reap(str(tmpdir), dry_run=True) == [orphan]
+    assert os.path.isdir(orphan)
+
+    assert reap(str(tmpdir)) == [orphan]
+    assert not os.path.exists(orphan)
+    assert os.path.isdir(owned)
+    assert os.path.isdir(unmarked)
+
+
+def test_reap_cli(tmpdir, capsys):
+    orphan = make_cluster_dir(tmpdir, "orphan", dead_pid())
+    assert main(["reap", "--temp-dir", str(tmpdir)]) == 0
+    assert capsys.readouterr().out.splitlines() == [orphan]
+    assert not os.path.exists(orphan)
+
+
+def start_fake_postmaster(*args):
+    # Naming the program postgres makes the command line look like one
+    return subprocess.Popen(
+        ["postgres", "-c", "import time; time.sleep(60)"] + list(args),
+        executable=sys.executable,
+    )
+
+
+def write_postmaster_pid(data_dir, pid):
+    with open(os.path.join(data_dir, "postmaster.pid"), "w") as f:
+        f.write("{}\n{}\n".format(pid, data_dir))
+
+
+def test_reap_stops_postmaster(tmpdir):
+    orphan = make_cluster_dir(tmpdir, "orphan", dead_pid())
+
+    data_dir = os.path.join(orphan, DATA_DIR)
+    postmaster = start_fake_postmaster("-D", data_dir)
+    write_postmaster_pid(data_dir, postmaster.pid)
+
+    assert reap(str(tmpdir), timeout=0.5) == [orphan]
+    assert postmaster.wait() != 0
+    assert not os.path.exists(orphan)
+
+
+def test_reap_skips_other_users_postmaster(tmpdir, monkeypatch):
+    orphan = make_cluster_dir(tmpdir, "orphan", dead_pid())
+    other = make_cluster_dir(tmpdir, "other", dead_pid())
+
+    data_dir = os.path.join(orphan, DATA_DIR)
+    postmaster = start_fake_postmaster("-D", data_dir)
+    write_postmaster_pid(data_dir, postmaster.pid)
+
+    # Signalling a process of another user fails with EPERM
+    kill = os.kill
+
+    def fake_kill(pid, sig):
+        if pid == postmaster.pid and sig != 0:
+            raise OSError(errno.EPERM, os.strerror(errno.EPERM))
+        kill(pid, sig)
+    monkeypatch.setattr(os, "kill", fake_kill)
+
+    try:
+        assert reap(str(tmpdir), timeout=0.5) == [other]
+        assert postmaster.poll() is None
+        assert os.path.isdir(orphan)
+    finally:
+        kill(postmaster.pid, signal.SIGKILL)
+        postmaster.wait()
+
+
+def test_reap_ignores_reused_pid(tmpdir):
+    orphan = make_cluster_dir(tmpdir, "orphan", dead_pid())
+
+    # A postgres process serving another data directory got the PID
+    other = start_fake_postmaster("-D", str(tmpdir.join("other")))
+    try:
+        write_postmaster_pid(os.path.join(orphan, DATA_DIR), other.pid)
+        assert reap(str(tmpdir), timeout=0.5) == [orphan]
+        assert other.poll() is None
+    finally:
+        other.kill()
+        other.wait()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Requires fork")
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_reap_lazy_cluster(tmpdir, monkeypatch, prefetch):
+    import tempfile
+
+    pg_bin_dir = find_postgres_bin_dir()
+    if pg_bin_dir is None:
+        pytest.skip("Unable to locate a PostgreSQL installation")
+    factory = PostgresFactory(pg_bin_dir)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+
+    # The owner is killed before the cluster is ever used. With prefetch
+    # that's while the data directory is being initialized.
+    clusters = []
+    pid = os.fork()
+    if pid == 0:
+        try:
+            clusters.append(factory.create_temporary_cluster(
+                lazy=True,
+                prefetch=prefetch,
+            ))
+            time.sleep(60)
+        finally:
+            os._exit(0)
+
+    # Wait for the directory to be tagged, and with prefetch for initdb to
+    # start writing the data directory
+    deadline = time.time() + 10
+    while not any(
+        read_marker(str(d)) and (d.join(DATA_DIR).check() or not prefetch)
+        for d in tmpdir.listdir()
+    ):
+        assert time.time() < deadline
+        time.sleep(0.01)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+    cluster_dirs = [str(d) for d in tmpdir.listdir()]
+    assert len(cluster_dirs) == 1
+    assert reap(str(tmpdir), dry_run=True) == cluster_dirs